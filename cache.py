@@ -2,7 +2,7 @@ import threading
 import time
 from os.path import isfile
 from pickle import load, dump
-from typing import List, Dict
+from typing import List, Dict, Set, Tuple
 
 from dns import SUPPORTED_TYPES
 
@@ -19,7 +19,22 @@ def _init_cache(filename) -> Dict[int, Dict[str, List[Record]]]:
         return {t: {} for t in SUPPORTED_TYPES}
 
     with open(filename, 'rb') as f:
-        return load(f)
+        cache = load(f)
+
+    # names are case-insensitive, older cache files may keep them as seen on the wire
+    for type_, request_to_list in cache.items():
+        normalized = {}
+
+        for request, records in request_to_list.items():
+            normalized.setdefault(normalize_name(request), []).extend(records)
+
+        cache[type_] = normalized
+
+    return cache
+
+
+def normalize_name(name):
+    return name.rstrip('.').lower()
 
 
 def _write_cache(cache, filename):
@@ -31,12 +46,55 @@ def _write_cache(cache, filename):
 # { type -> {requested string -> list of Record} }
 
 
+def _suffixes(name):
+    labels = normalize_name(name).split('.')
+
+    for i in range(len(labels)):
+        yield '.'.join(labels[i:])
+
+
+class _LabelIndex:
+    # { suffix -> set of (type, requested string) }, so a whole zone is flushed without a full scan
+
+    def __init__(self, cache):
+        self.__index = {}
+
+        for type_, request_to_list in cache.items():
+            for request in request_to_list:
+                self.add(type_, request)
+
+    def add(self, type_, name):
+        for suffix in _suffixes(name):
+            self.__index.setdefault(suffix, set()).add((type_, name))
+
+    def remove(self, type_, name):
+        for suffix in _suffixes(name):
+            keys = self.__index.get(suffix)
+
+            if keys is None:
+                continue
+
+            keys.discard((type_, name))
+
+            if len(keys) == 0:
+                del self.__index[suffix]
+
+    def find(self, suffix) -> Set[Tuple[int, str]]:
+        return set(self.__index.get(normalize_name(suffix), ()))
+
+
+def _is_expired(record, current_time, stale_window=0):
+    return current_time - record.creation_time > record.ttl + stale_window
+
+
 class _CacheCleaner(threading.Thread):
-    def __init__(self, cache, lock):
+    def __init__(self, cache, index, lock, stale_window):
         super().__init__()
         self.__cache = cache
+        self.__index = index
         self.__stopped = False
         self.__lock = lock
+        self.__stale_window = stale_window
 
     def run(self):
         while not self.__stopped:
@@ -57,7 +115,7 @@ class _CacheCleaner(threading.Thread):
                     expired_indexes = []
 
                     for i, record in enumerate(records):
-                        if current_time - record.creation_time > record.ttl:
+                        if _is_expired(record, current_time, self.__stale_window):
                             expired_indexes.append(i)
 
                     for i in sorted(expired_indexes, reverse=True):
@@ -68,14 +126,24 @@ class _CacheCleaner(threading.Thread):
 
                 for request in requests_to_delete:
                     del request_to_list[request]
+                    self.__index.remove(type_, request)
+
+
+# expired records are kept for stale_window seconds more (RFC 8767 serve-stale):
+# get() never returns them, get_stale() does
 
 
 class Cache:
-    def __init__(self, filename):
+    def __init__(self, filename, stale_window=0):
         self.__filename = filename
+        self.__stale_window = stale_window
         self.__cache = _init_cache(filename)
+        self.__index = _LabelIndex(self.__cache)
         self.__lock = threading.Lock()
-        self.__cleaner = _CacheCleaner(self.__cache, self.__lock)
+        self.__hits = 0
+        self.__misses = 0
+        self.__stale_hits = 0
+        self.__cleaner = _CacheCleaner(self.__cache, self.__index, self.__lock, stale_window)
         self.__cleaner.start()
 
     def __enter__(self):
@@ -85,26 +153,102 @@ class Cache:
         self.__cleaner.stop()
         _write_cache(self.__cache, self.__filename)
 
-    def get(self, type_, key) -> [List[Record], None]:
+    # count=True only for lookups answering a client query, so stats show the real hit rate
+
+    def get(self, type_, key, count=False) -> [List[Record], None]:
+        key = normalize_name(key)
+
         with self.__lock:
             if type_ not in SUPPORTED_TYPES:
                 raise ValueError(f'Unsupported type ({type_}) to use in cache')
 
-            if key not in self.__cache[type_]:
+            current_time = time.time()
+            records = [r for r in self.__cache[type_].get(key, ()) if not _is_expired(r, current_time)]
+
+            if len(records) == 0:
+                self.__misses += count
                 return None
 
-            return self.__cache[type_][key]
+            self.__hits += count
+            return records
+
+    def get_stale(self, type_, key, count=False) -> [List[Record], None]:
+        key = normalize_name(key)
 
-    def put(self, type_, key, ttl, *values):
         with self.__lock:
             if type_ not in SUPPORTED_TYPES:
                 raise ValueError(f'Unsupported type ({type_}) to use in cache')
 
             if key not in self.__cache[type_]:
-                self.__cache[type_][key] = list()
+                return None
+
+            current_time = time.time()
+            records = [r for r in self.__cache[type_][key]
+                       if _is_expired(r, current_time) and not _is_expired(r, current_time, self.__stale_window)]
+
+            if len(records) == 0:
+                return None
+
+            self.__stale_hits += count
+            return records
+
+    # replace=True drops every record of the key before adding values, otherwise only expired ones
+
+    def put(self, type_, key, ttl, *values, replace=False):
+        key = normalize_name(key)
+
+        with self.__lock:
+            if type_ not in SUPPORTED_TYPES:
+                raise ValueError(f'Unsupported type ({type_}) to use in cache')
 
             current_time = time.time()
 
+            if key not in self.__cache[type_]:
+                self.__cache[type_][key] = list()
+                self.__index.add(type_, key)
+            else:
+                records = self.__cache[type_][key]
+                records[:] = [] if replace else [r for r in records if not _is_expired(r, current_time)]
+
             for value in values:
                 record = Record(value, ttl, current_time)
                 self.__cache[type_][key].append(record)
+
+    def entries(self, key) -> Dict[int, List[Record]]:
+        key = normalize_name(key)
+
+        with self.__lock:
+            return {type_: list(request_to_list[key])
+                    for type_, request_to_list in self.__cache.items() if key in request_to_list}
+
+    def flush(self, key) -> int:
+        key = normalize_name(key)
+
+        with self.__lock:
+            return self._delete([(type_, key) for type_ in self.__cache if key in self.__cache[type_]])
+
+    def flush_suffix(self, suffix) -> int:
+        with self.__lock:
+            if normalize_name(suffix) == '':
+                return self._delete([(type_, key) for type_, request_to_list in self.__cache.items()
+                                     for key in request_to_list])
+
+            return self._delete(self.__index.find(suffix))
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                'entries': sum(len(request_to_list) for request_to_list in self.__cache.values()),
+                'records': sum(len(records) for request_to_list in self.__cache.values()
+                               for records in request_to_list.values()),
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'stale_hits': self.__stale_hits,
+            }
+
+    def _delete(self, keys) -> int:
+        for type_, key in keys:
+            del self.__cache[type_][key]
+            self.__index.remove(type_, key)
+
+        return len(keys)
@@ -5,6 +5,7 @@ import cache
 import dns
 import socket
 import errno
+import time
 
 
 class ClientError(Exception):
@@ -16,6 +17,15 @@ class ClientError(Exception):
         return self.__msg
 
 
+class UpstreamError(ClientError):
+    # upstream did not answer in time, is unreachable or failed (SERVFAIL): worth retrying later
+    pass
+
+
+# reply code of an upstream server failure
+SERVFAIL = 2
+
+
 class Client:
     def __init__(self, cache_: cache.Cache):
         self.cache = cache_
@@ -27,14 +37,17 @@ class Client:
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    def resolve_query(self, query: dns.Query, parent_server) -> List[dns.Answer]:
+    def resolve_query(self, query: dns.Query, parent_server, deadline=None) -> List[dns.Answer]:
         records = self.cache.get(query.type, query.name)
 
         if records is None:
             print(f'There is no records for: {dns.Type(query.type).name} {query.name}. Resolving at {parent_server}...')
-            self._resolve_query(query, parent_server)
+            self._resolve_query(query, parent_server, deadline)
             records = self.cache.get(query.type, query.name)
 
+        if records is None:
+            raise ClientError(f'No records for: {dns.Type(query.type).name} {query.name}')
+
         answers = []
 
         for record in records:
@@ -42,16 +55,19 @@ class Client:
 
         return answers
 
-    def resolve(self, bytes_: bytes, parent_server) -> List[dns.Answer]:
+    def resolve(self, bytes_: bytes, parent_server, deadline=None) -> List[dns.Answer]:
         package = self.__parser.parse(bytes_)
         query = package.queries[0]
 
         records = self.cache.get(query.type, query.name)
 
         if records is None:
-            self._resolve_bytes(bytes_, parent_server)
+            self._resolve_bytes(bytes_, parent_server, deadline)
             records = self.cache.get(query.type, query.name)
 
+        if records is None:
+            raise ClientError(f'No records for: {dns.Type(query.type).name} {query.name}')
+
         answers = []
 
         for record in records:
@@ -59,21 +75,46 @@ class Client:
 
         return answers
 
-    def _resolve_query(self, q: dns.Query, parent_server):
+    def resolve_name_server(self, name, deadline=None):
+        try:
+            return self.resolve_query(dns.Query(dns.Type.A, name), ('8.8.8.8', 53), deadline)[0].data
+        except UpstreamError:
+            raise
+        except ClientError as e:
+            raise UpstreamError(f'Cant resolve name server address: {e.message}')
+
+    def resolve_stale(self, query: dns.Query, ttl) -> [List[dns.Answer], None]:
+        records = self.cache.get_stale(query.type, query.name, count=True)
+
+        if records is None:
+            return None
+
+        return [dns.Answer(query.type, query.name, ttl, record.value) for record in records]
+
+    def _resolve_query(self, q: dns.Query, parent_server, deadline):
         p = dns.Package(randint(1, 2**16 - 1), dns.Flags(recursion_desired=1), [q], [], [], [])
 
-        self._resolve_bytes(p.to_bytes(), parent_server)
+        self._resolve_bytes(p.to_bytes(), parent_server, deadline)
+
+    def _resolve_bytes(self, bytes_, parent_server, deadline):
+        # deadline is an absolute time.time() value shared by all the steps of one client query
+        timeout = 1 if deadline is None else deadline - time.time()
+
+        if timeout <= 0:
+            raise UpstreamError('Cant resolve request: deadline exceeded')
 
-    def _resolve_bytes(self, bytes_, parent_server):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.settimeout(1)
-            s.sendto(bytes_, parent_server)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.settimeout(timeout)
+                s.sendto(bytes_, parent_server)
 
-            ans = s.recv(2048)
+                ans = s.recv(2048)
 
             p = self.__parser.parse(ans)
 
+            if p.flags.reply_code == SERVFAIL:
+                raise UpstreamError(f'Cant resolve: server failure at {parent_server}')
+
             print('Resolved. Now we know:')
 
             for answer in p.answers:
@@ -89,8 +130,8 @@ class Client:
                 print(answer)
 
         except socket.timeout:
-            raise ClientError('Cant resolve request: is network unreachable?')
+            raise UpstreamError('Cant resolve request: is network unreachable?')
         except OSError as e:
             if e.errno == errno.ENETUNREACH:
-                raise ClientError('Cant resolve: network is unreachable')
-            raise e
+                raise UpstreamError('Cant resolve: network is unreachable')
+            raise UpstreamError(f'Cant resolve: {e}')
@@ -0,0 +1,235 @@
+import os
+import re
+import socket
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import byteprint
+import cache
+import dns
+from client import ClientError
+
+
+# control protocol: one text command per connection, answered with text lines
+#
+#   show <name>                   records of the name of every type: remaining ttl, live or stale
+#   flush <name>                  forget the name
+#   flush-suffix <suffix>         forget the suffix and every name under it ('.' for everything)
+#   stats                         cache counters
+#   import <file>                 replace records from lines: <type> <name> <ttl> <value>, all or nothing
+#   warm <file>                   resolve names from lines: [<type>] <name>
+
+
+class ControlError(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.__msg = msg
+
+    @property
+    def message(self):
+        return self.__msg
+
+
+def _parse_type(s) -> [dns.Type, None]:
+    return dns.Type.__members__.get(s.upper())
+
+
+_LABEL = re.compile(r'^(?!-)[a-z0-9_-]{1,63}(?<!-)$', re.IGNORECASE)
+
+
+def _is_host_name(name) -> bool:
+    name = name.rstrip('.')
+
+    return 0 < len(name) <= 253 and all(_LABEL.match(label) for label in name.split('.'))
+
+
+def _parse_value(type_, value) -> [str, None]:
+    # returns the value in the form Answer.to_bytes() expects, None if it is invalid
+    try:
+        if type_ == dns.Type.A:
+            return byteprint.to_ipv4_address(socket.inet_pton(socket.AF_INET, value))
+
+        if type_ == dns.Type.AAAA:
+            return byteprint.to_ipv6_address(socket.inet_pton(socket.AF_INET6, value))
+    except OSError:
+        return None
+
+    return value.rstrip('.').lower() if _is_host_name(value) else None
+
+
+def read_queries(filename) -> List[dns.Query]:
+    queries = []
+
+    with open(filename) as f:
+        for n, line in enumerate(f, 1):
+            parts = line.split()
+
+            if len(parts) == 0 or parts[0].startswith('#'):
+                continue
+
+            if len(parts) == 1:
+                parts.insert(0, 'A')
+
+            if len(parts) != 2 or _parse_type(parts[0]) is None or not _is_host_name(parts[1]):
+                raise ControlError(f'Invalid warm-up line {n}')
+
+            queries.append(dns.Query(_parse_type(parts[0]), parts[1].rstrip('.')))
+
+    return queries
+
+
+def import_records(cache_: cache.Cache, filename) -> int:
+    # the whole file is checked before the cache is touched,
+    # records of every imported (type, name) replace the cached ones
+    records = []
+
+    with open(filename) as f:
+        for n, line in enumerate(f, 1):
+            parts = line.split()
+
+            if len(parts) == 0 or parts[0].startswith('#'):
+                continue
+
+            if len(parts) != 4 or _parse_type(parts[0]) is None or not parts[2].isdigit() or \
+                    int(parts[2]) >= 2**32 or not _is_host_name(parts[1]):
+                raise ControlError(f'Invalid import line {n}')
+
+            type_, name, ttl, value = parts
+            type_ = _parse_type(type_)
+            value = _parse_value(type_, value)
+
+            if value is None:
+                raise ControlError(f'Invalid {type_.name} value at import line {n}')
+
+            records.append((type_, cache.normalize_name(name), int(ttl), value))
+
+    replaced = set()
+
+    for type_, name, ttl, value in records:
+        cache_.put(type_, name, ttl, value, replace=(type_, name) not in replaced)
+        replaced.add((type_, name))
+
+    return len(records)
+
+
+def warm(resolve, queries: List[dns.Query], timeout, workers=16) -> int:
+    def warm_one(query):
+        try:
+            resolve(query, time.time() + timeout)
+            return True
+        except ClientError as e:
+            print(f'Warm-up of {query} failed: {e.message}')
+            return False
+        except Exception as e:
+            print(f'Warm-up of {query} failed: {e!r}')
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(warm_one, queries))
+
+
+# seconds to wait for a command from a connected client
+CONNECTION_TIMEOUT = 5
+
+
+class ControlServer(threading.Thread):
+    def __init__(self, path, cache_: cache.Cache, resolve, timeout):
+        super().__init__(daemon=True)
+        self.__path = path
+        self.__cache = cache_
+        self.__resolve = resolve
+        self.__timeout = timeout
+
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ControlError(f'Control socket path exists and is not a socket: {path}')
+
+            os.remove(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.socket.close()
+        os.remove(self.__path)
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                break
+
+            try:
+                self._handle(connection)
+            except Exception as e:
+                print(f'Control connection failed: {e!r}')
+
+    def _handle(self, connection):
+        connection.settimeout(CONNECTION_TIMEOUT)
+
+        with connection, connection.makefile('rw') as f:
+            try:
+                response = self.execute(f.readline())
+            except ControlError as e:
+                response = f'error: {e.message}\n'
+            except Exception as e:
+                print(f'Control command failed: {e!r}')
+                response = f'error: {e}\n'
+
+            f.write(response)
+
+    def execute(self, line) -> str:
+        parts = line.split()
+
+        if len(parts) == 0:
+            raise ControlError('Empty command')
+
+        command, args = parts[0], parts[1:]
+
+        if command == 'stats' and len(args) == 0:
+            return ''.join(f'{k}: {v}\n' for k, v in self.__cache.stats().items())
+
+        if len(args) != 1:
+            raise ControlError(f'Unknown command: {line.strip()}')
+
+        arg = args[0]
+
+        if command == 'show':
+            return self._show(arg)
+
+        if command == 'flush':
+            return f'flushed: {self.__cache.flush(arg)}\n'
+
+        if command == 'flush-suffix':
+            return f'flushed: {self.__cache.flush_suffix(arg)}\n'
+
+        if command == 'import':
+            return f'imported: {import_records(self.__cache, arg)}\n'
+
+        if command == 'warm':
+            queries = read_queries(arg)
+            return f'warmed: {warm(self.__resolve, queries, self.__timeout)}/{len(queries)}\n'
+
+        raise ControlError(f'Unknown command: {line.strip()}')
+
+    def _show(self, name) -> str:
+        current_time = time.time()
+        s = ''
+
+        for type_, records in self.__cache.entries(name).items():
+            for record in records:
+                left = record.creation_time + record.ttl - current_time
+                state = 'live' if left >= 0 else 'stale'
+                s += f'{dns.Type(type_).name} {name.rstrip(".").lower()} {int(max(left, 0))} {record.value} {state}\n'
+
+        return s
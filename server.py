@@ -1,24 +1,47 @@
 import argparse
 import socket
+import threading
+import time
 import dns
 
-from client import Client, ClientError
-from cache import Cache
+from client import Client, ClientError, UpstreamError
+from cache import Cache, normalize_name
+from control import ControlServer, read_queries, warm
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='simple dns server')
     parser.add_argument('--cache-file', required=False, default='cache.bin')
+    parser.add_argument('--stale-window', required=False, type=int, default=86400,
+                        help='seconds to keep expired records for answering when upstream is down')
+    parser.add_argument('--query-timeout', required=False, type=float, default=1.8,
+                        help='overall upstream latency budget per client query in seconds')
+    parser.add_argument('--control-socket', required=False, default='dns-control.sock',
+                        help='unix socket to inspect, flush, import and warm the cache at runtime')
+    parser.add_argument('--warm-file', required=False, default=None,
+                        help='file with names to resolve concurrently at startup: [<type>] <name> per line')
 
     return parser.parse_args()
 
 
+# ttl of answers made from expired records, as recommended by RFC 8767
+STALE_ANSWER_TTL = 30
+# upstream budget of background refresh after answering from stale records
+REFRESH_TIMEOUT = 10
+# after upstream failed for a name, answer it from stale records without waiting for upstream this long
+FAILURE_RECHECK = 30
+
+
 class Server:
-    def __init__(self, client: Client):
+    def __init__(self, client: Client, query_timeout=1.8):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(('127.0.0.1', 53))
         self.client = client
+        self.query_timeout = query_timeout
         self.__parser = dns.Parser()
+        self.__refreshing = set()
+        self.__failed_at = {}
+        self.__refreshing_lock = threading.Lock()
 
     def __enter__(self):
         return self
@@ -41,18 +64,15 @@ class Server:
 
                     print(f'Request: {package}\n>>>>>>>>>>>>>>>>>>')
 
-                    if self.client.cache.get(package.queries[0].type, package.queries[0].name) is not None:
+                    records = self.client.cache.get(package.queries[0].type, package.queries[0].name, count=True)
+
+                    if records is not None:
                         answers = []
-                        for record in self.client.cache.get(package.queries[0].type, package.queries[0].name):
+                        for record in records:
                             answers.append(
                                 dns.Answer(package.queries[0].type, package.queries[0].name, record.ttl, record.value))
-                    elif package.queries[0].type == dns.Type.A or package.queries[0].type == dns.Type.AAAA:
-                        ns_answers = self.client.resolve_query(dns.Query(dns.Type.NS, package.queries[0].name),
-                                                               ('8.8.8.8', 53))
-
-                        answers = self.client.resolve_query(package.queries[0], (ns_answers[0].name_server, 53))
                     else:
-                        answers = self.client.resolve_query(package.queries[0], ('8.8.8.8', 53))
+                        answers = self._resolve_or_stale(package.queries[0])
 
                     answer_package = dns.Package(package.id,
                                                  dns.Flags(is_response=1, recursion_available=1, recursion_desired=1),
@@ -75,13 +95,108 @@ class Server:
         except KeyboardInterrupt:
             print('\nStopping server...')
 
+    def resolve(self, query: dns.Query, deadline):
+        if query.type == dns.Type.A or query.type == dns.Type.AAAA:
+            ns_answers = self.client.resolve_query(dns.Query(dns.Type.NS, query.name), ('8.8.8.8', 53), deadline)
+            ns_address = self.client.resolve_name_server(ns_answers[0].name_server, deadline)
+
+            return self.client.resolve_query(query, (ns_address, 53), deadline)
+
+        return self.client.resolve_query(query, ('8.8.8.8', 53), deadline)
+
+    def _resolve_or_stale(self, query: dns.Query):
+        key = (query.type, normalize_name(query.name))
+
+        if self._recently_failed(key):
+            answers = self.client.resolve_stale(query, STALE_ANSWER_TTL)
+
+            if answers is not None:
+                print('Upstream failed recently\nAnswering with stale records')
+                self._start_refresh(query)
+
+                return answers
+
+        try:
+            answers = self.resolve(query, time.time() + self.query_timeout)
+        except UpstreamError as e:
+            answers = self.client.resolve_stale(query, STALE_ANSWER_TTL)
+
+            if answers is None:
+                raise e
+
+            self._mark_failed(key)
+
+            print(f'Resolving error: {e.message}\nAnswering with stale records')
+            self._start_refresh(query)
+
+            return answers
+
+        self._clear_failed(key)
+
+        return answers
+
+    def _recently_failed(self, key):
+        with self.__refreshing_lock:
+            failed_at = self.__failed_at.get(key)
+
+            if failed_at is None:
+                return False
+
+            if time.time() - failed_at > FAILURE_RECHECK:
+                del self.__failed_at[key]
+                return False
+
+            return True
+
+    def _mark_failed(self, key):
+        current_time = time.time()
+
+        with self.__refreshing_lock:
+            for k in [k for k, failed_at in self.__failed_at.items() if current_time - failed_at > FAILURE_RECHECK]:
+                del self.__failed_at[k]
+
+            self.__failed_at[key] = current_time
+
+    def _clear_failed(self, key):
+        with self.__refreshing_lock:
+            self.__failed_at.pop(key, None)
+
+    def _start_refresh(self, query: dns.Query):
+        key = (query.type, normalize_name(query.name))
+
+        with self.__refreshing_lock:
+            if key in self.__refreshing:
+                return
+
+            self.__refreshing.add(key)
+
+        threading.Thread(target=self._refresh, args=(query, key), daemon=True).start()
+
+    def _refresh(self, query: dns.Query, key):
+        try:
+            self.resolve(query, time.time() + REFRESH_TIMEOUT)
+            self._clear_failed(key)
+        except UpstreamError as e:
+            self._mark_failed(key)
+            print(f'Background refresh of {query} failed: {e.message}')
+        except Exception as e:
+            print(f'Background refresh of {query} failed: {e}')
+        finally:
+            with self.__refreshing_lock:
+                self.__refreshing.remove(key)
+
 
 def main():
     args = parse_args()
 
-    with Cache(args.cache_file) as cache, \
+    with Cache(args.cache_file, args.stale_window) as cache, \
             Client(cache) as client, \
-            Server(client) as server:
+            Server(client, args.query_timeout) as server, \
+            ControlServer(args.control_socket, cache, server.resolve, args.query_timeout):
+        if args.warm_file is not None:
+            queries = read_queries(args.warm_file)
+            threading.Thread(target=warm, args=(server.resolve, queries, args.query_timeout), daemon=True).start()
+
         server.run()
 
 